@@ -6,8 +6,9 @@ import os, sys
 import threading
 import subprocess
 import functools
+import codecs
 import re
-from . import plugin, core
+from . import plugin, core, jobs, watch, preview
 
 class CommandoCommand(plugin.CommandoRun):
   pass
@@ -34,12 +35,13 @@ class CommandoExecCommand(plugin.CommandoCmd):
   def cmd(self, context, input, args):
     # kill all running procs (if exists)
     if 'kill' in args:
-      if self.procs:
-        proc = self.procs.pop(0)
-        while proc:
-          proc.kill()
-        self.procs = []
-        self.killed = True
+      for job in jobs.running_jobs():
+        if jobs.job_status(job) == 'running':
+          jobs.kill_job(job['id'])
+      for proc in self.procs:
+        proc.kill()
+      self.procs = []
+      self.killed = True
       return False
 
     if not 'cmd' in args:
@@ -68,10 +70,35 @@ class CommandoExecCommand(plugin.CommandoCmd):
     try:
       context['input'] = input # for variable subsitution
       self._do_var_subs(context, args['cmd'])
-      new_proc = CommandoProcess(args['cmd'], functools.partial(self.finish, context),
-        input=input, env=env, encoding=encoding)
-      new_proc.start()
-      self.procs.append(new_proc)
+      if isinstance(args['cmd'], list):
+        detail = ' '.join(str(c) for c in args['cmd'])
+      else:
+        detail = str(args['cmd'])
+
+      # stdin can be streamed straight from the view instead of the chain input
+      stdin = [{"input": input}]
+      per_region = 'per_region' in args and args['per_region']
+      if 'stdin' in args and args['stdin'] in ('$buffer', '$selection'):
+        view = self.get_view(context)
+        regions = core.view_regions(view, selection=(args['stdin'] == '$selection'))
+        if per_region:
+          stdin = [{"chunks": core.read_view(view, [region])} for region in regions]
+        else:
+          stdin = [{"chunks": core.read_view(view, regions)}]
+      else:
+        per_region = False
+
+      results = [None] * len(stdin)
+      for i, proc_input in enumerate(stdin):
+        if per_region:
+          on_done = functools.partial(self.finish_regions, context, results, i)
+        else:
+          on_done = functools.partial(self.finish, context)
+        new_proc = CommandoProcess(args['cmd'], on_done,
+          env=env, encoding=encoding, on_update=jobs.notify, **proc_input)
+        jobs.attach_proc(context, new_proc, detail)
+        new_proc.start()
+        self.procs.append(new_proc)
 
       if not self.watching:
         self.watching = True
@@ -91,12 +118,9 @@ class CommandoExecCommand(plugin.CommandoCmd):
   def update_procs_status(self):
     self.loop = (self.loop+1) % 4
 
-    if self.procs:
-      for i in range(0,len(self.procs)-1):
-        if not self.procs[i].poll():
-          del self.procs[i]
+    self.procs = [proc for proc in self.procs if proc.poll()]
 
-    if self.procs[0].poll():
+    if self.procs:
       # we don't want to flash the status bar with commands that run quickly,
       # so we only show status bar after the first watch_proc call
       # sublime.status_message(' '.join(self.proc_cmd) + ' in ' + os.getcwd() + ' ' +
@@ -115,11 +139,46 @@ class CommandoExecCommand(plugin.CommandoCmd):
       self.watching = False
 
   def finish(self, context, exitcode, stdout, stderr):
+    jobs.end_step(context, exitcode)
+    if jobs.is_killed(context):
+      return
+
     if exitcode:
-      sublime.error_message("Error (" + str(exitcode) + "): " + stderr)
+      if context.get('on_error'):
+        # the chain handles its own errors
+        # (watch chains, background preview fetches); they get all the output,
+        # linters report their findings on stdout
+        context['commands'] = context.pop('on_error')
+        context['input'] = "Error (" + str(exitcode) + "): " + (stdout or "") + (stderr or "")
+        core.next_commando(context)
+      else:
+        jobs.end_job(context, exitcode)
+        sublime.error_message("Error (" + str(exitcode) + "): " + stderr)
     elif context['commands']:
       context['input'] = stdout+stderr
       core.next_commando(context)
+    else:
+      jobs.end_job(context)
+
+  def finish_regions(self, context, results, index, exitcode, stdout, stderr):
+    """Wait for every region's process; the chain gets one output per region."""
+    results[index] = (exitcode, stdout, stderr)
+    if None in results:
+      return
+
+    for exitcode, stdout, stderr in results:
+      if exitcode:
+        return self.finish(context, exitcode, stdout, stderr)
+
+    jobs.end_step(context)
+    if jobs.is_killed(context):
+      return
+
+    if context['commands']:
+      context['input'] = [stdout+stderr for exitcode, stdout, stderr in results]
+      core.next_commando(context)
+    else:
+      jobs.end_job(context)
 
 class CommandoKillCommand(plugin.CommandoRun):
   def commands(self):
@@ -127,6 +186,35 @@ class CommandoKillCommand(plugin.CommandoRun):
       ["commando_exec", {"kill": True}]
     ]
 
+class CommandoJobsCommand(sublime_plugin.WindowCommand):
+  """Live panel of running and recently finished commando chains."""
+  def run(self):
+    jobs.show_panel(self.window)
+
+class CommandoKillJobCommand(sublime_plugin.WindowCommand):
+  def run(self, job_id=None):
+    if job_id is not None:
+      jobs.kill_job(job_id)
+      return
+
+    running = jobs.running_jobs()
+    if not running:
+      sublime.status_message('No running commando jobs')
+      return
+
+    items = [["Kill all", str(len(running)) + " running jobs"]]
+    for job in running:
+      items.append(["#" + str(job['id']) + " " + job['name'], jobs.job_status(job)])
+
+    def on_done(i):
+      if i == 0:
+        for job in running:
+          jobs.kill_job(job['id'])
+      elif i > 0:
+        jobs.kill_job(running[i-1]['id'])
+
+    self.window.show_quick_panel(items, on_done)
+
 class CommandoShowPanelCommand(plugin.CommandoCmd):
   def cmd(self, context, input, args):
     if input:
@@ -171,8 +259,14 @@ class CommandoFileWatcher(sublime_plugin.EventListener):
     context = view.settings().get('on_close_context')
     if context:
       context['input'] = view.substr(sublime.Region(0, view.size()))
+      jobs.start_job(context)
       core.next_commando(context)
 
+  def on_post_save_async(self, view):
+    if view.file_name() and view.window():
+      for w in watch.watches_for(view.window().id(), view.file_name()):
+        watch.run_file(w, watch.normalize(w, view.file_name()), view.id())
+
 class CommandoQuickPanelCommand(plugin.CommandoCmd):
   def cmd(self, context, input, args):#on_done=None):
     if 'on_done' in args:
@@ -180,11 +274,26 @@ class CommandoQuickPanelCommand(plugin.CommandoCmd):
     else:
       on_done = context['commands']
 
+    if 'prefetch' in args:
+      prefetch = args['prefetch']
+    else:
+      prefetch = 1
+
     if input:
-      core.quick_panel(context, input, on_done)
+      on_highlighted = None
+      if 'on_highlighted' in args:
+        on_highlighted = preview.highlighter(context, input, args['on_highlighted'], prefetch)
+      core.quick_panel(context, input, on_done, on_highlighted=on_highlighted)
 
     return False
 
+class CommandoPreviewStoreCommand(plugin.CommandoCmd):
+  """Last step of a quick panel preview chain, see preview.py."""
+  def cmd(self, context, input, args):
+    failed = 'failed' in args and args['failed']
+    generation = args['generation'] if 'generation' in args else None
+    preview.store(args['preview_key'], input, failed, generation)
+
 class CommandoInputPanelCommand(plugin.CommandoCmd):
   def cmd(self, context, input, args):#on_done=None, on_change=None, on_cancel=None):
     if not 'caption' in args:
@@ -296,29 +405,98 @@ class CommandoLoopCommand(plugin.CommandoCmd):
     for i in input:
       loop_context = dict(context)
       loop_context['input'] = i
+      loop_context.pop('job_id', None) # each iteration is its own job
       core.run_commando(list(args['commands']), context=loop_context)
 
+    jobs.end_job(context)
     return False
 
+class CommandoWatchCommand(plugin.CommandoCmd):
+  """Re-run a chain whenever a file it covers is saved with new content.
+
+  Input, if any, is a list of files to run the chain on right away.
+  """
+  def cmd(self, context, input, args):
+    if 'commands' not in args or not args['commands']:
+      return False
+
+    if 'name' in args:
+      name = args['name']
+    else:
+      name = 'default'
+
+    if 'pattern' in args:
+      pattern = args['pattern']
+    else:
+      pattern = '*'
+
+    if 'working_dir' in args:
+      working_dir = args['working_dir']
+    else:
+      working_dir = core.get_working_dir(context)
+
+    w = watch.add_watch(context, name, args['commands'], working_dir, pattern)
+
+    if input:
+      if not isinstance(input, list):
+        input = [input]
+      filenames = [watch.normalize(w, f.strip()) for f in input if isinstance(f, str) and f.strip() != '']
+      # hashing every file would block the UI
+      sublime.set_timeout_async(lambda: watch.run_files(w, filenames), 0)
+
+    sublime.status_message('Commando watching: ' + name)
+    return False
+
+class CommandoWatchResultCommand(plugin.CommandoCmd):
+  """Last step of a watch chain, stores the output for the file."""
+  def cmd(self, context, input, args):
+    w = watch.get_watch(context['window_id'], args['watch'])
+    if not w:
+      return
+
+    if isinstance(input, list):
+      input = "\n".join(str(i) for i in input)
+
+    failed = 'failed' in args and args['failed']
+    if watch.set_result(w, args['file'], args['run'], args['hash'], input, failed):
+      watch.update_panel(w, args['file'], show=True)
+
+class CommandoUnwatchCommand(sublime_plugin.WindowCommand):
+  def run(self, name=None):
+    removed = watch.remove_watch(self.window.id(), name)
+    sublime.status_message('Commando stopped ' + str(len(removed)) + ' watch(es)')
 
 class SimpleInsertCommand(sublime_plugin.TextCommand):
   def run(self, edit, contents):
     self.view.insert(edit, 0, contents)
     self.view.run_command("goto_line", {"line":1})
 
+class SimpleReplaceCommand(sublime_plugin.TextCommand):
+  def run(self, edit, contents, begin=0, end=None):
+    if end is None:
+      end = self.view.size()
+    self.view.replace(edit, sublime.Region(begin, end), contents)
+
 class CommandoProcess(threading.Thread):
-  def __init__(self, cmd, on_done, input=None, env=None, path=None, encoding="utf-8"):
+  def __init__(self, cmd, on_done, input=None, env=None, path=None, encoding="utf-8", on_update=None, chunks=None):
     super(CommandoProcess, self).__init__()
     self.proc = None
+    self.pid = None
     self.killed = False
     self.cmd = cmd
     self.on_done = on_done
-    if input is None:
-      input = ""
-    self.input = input.encode(encoding)
+    self.on_update = on_update
+    if chunks is None:
+      if input is None:
+        input = ""
+      if not isinstance(input, str):
+        raise TypeError("commando_exec input must be a string, not " + type(input).__name__)
+      chunks = [input]
+    self.input = chunks # str chunks, written to stdin as they are produced
     self.env = env
     self.path = path
     self.encoding = encoding
+    self.bytes_read = [0, 0] # stdout, stderr; each reader only updates its own
 
   def run(self):
     # Hide the console window on Windows
@@ -340,11 +518,57 @@ class CommandoProcess(threading.Thread):
     for k, v in proc_env.items():
       proc_env[k] = os.path.expandvars(v)
 
-    self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 startupinfo=startupinfo, env=proc_env)
+    try:
+      self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   startupinfo=startupinfo, env=proc_env)
+    except Exception as e:
+      self.killed = True # nothing left to wait on
+      error = str(e)
+      sublime.set_timeout(lambda: self.on_done(1, "", error), 0)
+      if self.path:
+        os.environ["PATH"] = old_path
+      return
+    self.pid = self.proc.pid
+    self._updated()
+
+    # read both pipes as output arrives so the jobs panel can follow along
+    stdout_chunks = []
+    stderr_chunks = []
+    readers = [
+      threading.Thread(target=self._read, args=(self.proc.stdout, stdout_chunks, 0)),
+      threading.Thread(target=self._read, args=(self.proc.stderr, stderr_chunks, 1))
+    ]
+    for reader in readers:
+      reader.start()
 
-    (stdout, stderr) = self.proc.communicate(input=self.input)
+    stdin_error = None
+    try:
+      encoder = codecs.getincrementalencoder(self.encoding)()
+      for chunk in self.input:
+        if self.killed:
+          break
+        self.proc.stdin.write(encoder.encode(chunk))
+      self.proc.stdin.write(encoder.encode("", True))
+    except (IOError, OSError):
+      pass # process exited without reading all of its input
+    except Exception as e:
+      # the input couldn't be produced or encoded, don't let the process
+      # carry on with part of it
+      stdin_error = str(e)
+      self.kill()
+    finally:
+      try:
+        self.proc.stdin.close()
+      except (IOError, OSError):
+        pass
+
+    for reader in readers:
+      reader.join()
+    self.proc.wait()
+
+    stdout = b''.join(stdout_chunks)
+    stderr = b''.join(stderr_chunks)
 
     try:
       stdout = stdout.decode(self.encoding)
@@ -357,15 +581,38 @@ class CommandoProcess(threading.Thread):
       print("[Decode error - stderr not " + self.encoding + "]\n")
 
     exitcode = self.exit_code()
+    if stdin_error:
+      exitcode = 1
+      stderr = "[stdin error - " + stdin_error + "]"
 
     sublime.set_timeout(lambda: self.on_done(exitcode, stdout, stderr), 0)
 
     if self.path:
       os.environ["PATH"] = old_path
 
+  def _read(self, pipe, chunks, index):
+    while True:
+      data = os.read(pipe.fileno(), 2**15)
+      if not data:
+        break
+      chunks.append(data)
+      self.bytes_read[index] += len(data)
+      self._updated()
+    pipe.close()
+
+  @property
+  def bytes_out(self):
+    return sum(self.bytes_read)
+
+  def _updated(self):
+    if self.on_update:
+      self.on_update()
+
   def kill(self):
     if not self.killed:
       self.killed = True
+      if self.proc is None:
+        return
       if sys.platform == "win32":
         # terminate would not kill process opened by the shell cmd.exe, it will
         # only kill cmd.exe leaving the child running
@@ -376,7 +623,11 @@ class CommandoProcess(threading.Thread):
         self.proc.terminate()
 
   def poll(self):
+    if self.proc is None:
+      return not self.killed
     return self.proc.poll() == None
 
   def exit_code(self):
+    if self.proc is None:
+      return None
     return self.proc.poll()
@@ -3,6 +3,9 @@
 """
 import sublime, sublime_plugin
 import os
+from . import jobs
+
+VIEW_CHUNK_SIZE = 2**16
 
 #
 # Module functions
@@ -111,6 +114,37 @@ def get_working_dir(context):
     return os.path.dirname(view.file_name())
   return None
 
+def view_regions(view, selection=False):
+  """Regions to read from a view: its non-empty selections, or the whole buffer.
+
+  Like most Sublime commands, an empty selection falls back to the whole buffer.
+  """
+  if selection:
+    regions = [sublime.Region(r.begin(), r.end()) for r in view.sel() if not r.empty()]
+    if regions:
+      return regions
+  return [sublime.Region(0, view.size())]
+
+def read_view(view, regions, chunk_size=VIEW_CHUNK_SIZE):
+  """Yield the text of the regions, chunk_size characters at a time.
+
+  Regions are separated by a newline.  Nothing is read until the generator
+  is consumed, so the buffer never has to be copied in one piece.  The view
+  is read live, so a RuntimeError is raised if it is closed or edited before
+  all chunks have been read, rather than handing out mixed or cut-off text.
+  """
+  change_count = view.change_count()
+  for i, region in enumerate(regions):
+    if i > 0:
+      yield "\n"
+    pos = region.begin()
+    while pos < region.end():
+      if not view.is_valid() or view.change_count() != change_count:
+        raise RuntimeError("view was closed or changed while it was being read")
+      end = min(pos + chunk_size, region.end())
+      yield view.substr(sublime.Region(pos, end))
+      pos = end
+
 def panel(context, content, name="commando"):
   """Display a Sublime panel in the provided context."""
   if content and content.rstrip() != '':
@@ -119,16 +153,23 @@ def panel(context, content, name="commando"):
     p.run_command("simple_insert", {"contents": content})
     window.run_command("show_panel", {"panel":"output."+name})
 
-def quick_panel(context, items, on_done_cmd, flags=sublime.MONOSPACE_FONT, selected_idx=-1, on_highlighted_cmd=None):
-  """Open a Sublime quick_panel in the provided context."""
+def quick_panel(context, items, on_done_cmd, flags=sublime.MONOSPACE_FONT, selected_idx=-1, on_highlighted_cmd=None, on_highlighted=None):
+  """Open a Sublime quick_panel in the provided context.
+
+  If on_highlighted is given it is called with the highlighted index instead
+  of running on_highlighted_cmd (see preview.highlighter).
+  """
   def on_done(i):
     if on_done_cmd and i != -1:
       context['input'] = items[i]
       run_commando(on_done_cmd, context=context)
-  def on_highlighted(i):
+  def run_highlighted(i):
     if on_highlighted_cmd and i != -1:
       context['input'] = items[i]
-      run_commando(on_highlighted_cmd, context=context)
+      run_commando(list(on_highlighted_cmd), context=context)
+
+  if on_highlighted is None:
+    on_highlighted = run_highlighted
 
   get_window_by_context(context).show_quick_panel(items, on_done, flags, selected_idx, on_highlighted)
 
@@ -198,14 +239,21 @@ def run_commando(commands, context=None):
   if commands is not None:
     context['commands'] = commands
 
+  jobs.start_job(context)
+
   # and go!
   next_commando(context)
 
 def next_commando(context):
+  if jobs.is_killed(context):
+    return
+
   if not context['commands']:
+    jobs.end_job(context)
     return
 
   next_command = context['commands'].pop(0)
+  step = jobs.start_step(context, next_command)
 
   if isinstance(next_command, list):
     context['args'].update(next_command[1])
@@ -215,6 +263,7 @@ def next_commando(context):
 
   if not command_type:
     print('Command not found: ' + next_command)
+    jobs.end_job(context)
     return
 
   runner = None
@@ -244,4 +293,9 @@ def next_commando(context):
 
   if runner:
     runner.run_command(next_command, {"context": context})
+    # plain Sublime commands ignore the context, so the chain ends with them
+    if step and not step['handled']:
+      jobs.end_job(context)
+  else:
+    jobs.end_job(context)
 
@@ -0,0 +1,269 @@
+"""Commando - Job tracking.
+
+Every chain started through core.run_commando is recorded here as a job so
+the commando_jobs panel can show what is running and what just finished.
+"""
+import sublime
+import collections
+import itertools
+import threading
+import time
+
+PANEL_NAME = "commando_jobs"
+MAX_RECENT = 20      # finished jobs kept around for the panel
+REFRESH_DELAY = 250  # ms, minimum time between two panel refreshes
+TICK_DELAY = 1000    # ms, refresh rate while something is running
+
+_ids = itertools.count(1)
+_jobs = collections.OrderedDict()
+_lock = threading.Lock()
+_refresh_pending = False
+
+#
+# Job bookkeeping
+#
+
+def start_job(context):
+  """Make sure the context belongs to a running job, creating one if needed.
+
+  A context resumed after its job ended gets a new job, unless the job was
+  killed, in which case it stays killed so the chain doesn't continue.
+  Contexts marked 'untracked' (quick panel previews) get a hidden job: it is
+  left out of the panel and the kill list, and forgotten as soon as it ends.
+  """
+  with _lock:
+    job = _jobs.get(context.get('job_id'))
+    if job and (is_running(job) or job['killed']):
+      return job['id']
+    job_id = next(_ids)
+    _jobs[job_id] = {
+      "id": job_id,
+      "window_id": context.get('window_id'),
+      "name": _command_name(context['commands'][0]) if context['commands'] else '',
+      "started": time.time(),
+      "ended": None,
+      "exitcode": None,
+      "killed": False,
+      "hidden": bool(context.get('untracked')),
+      "on_end": [],
+      "steps": []
+    }
+    context['job_id'] = job_id
+    _prune()
+  notify()
+  return job_id
+
+def start_step(context, command):
+  """Record that the job is moving on to the given command."""
+  job = get_job(context)
+  if not job:
+    return
+  now = time.time()
+  with _lock:
+    if job['steps'] and job['steps'][-1]['ended'] is None:
+      job['steps'][-1]['ended'] = now
+    job['steps'].append({
+      "command": _command_name(command),
+      "detail": None,
+      "started": now,
+      "ended": None,
+      "handled": False,
+      "procs": []
+    })
+  notify()
+  return job['steps'][-1]
+
+def attach_proc(context, proc, detail=None):
+  """Attach a running CommandoProcess to the current step of the job."""
+  step = _current_step(context)
+  if step:
+    step['procs'].append(proc)
+    step['detail'] = detail
+  notify()
+
+def end_step(context, exitcode=None):
+  """Close the current step of the job."""
+  step = _current_step(context)
+  if step and step['ended'] is None:
+    step['ended'] = time.time()
+  job = get_job(context)
+  if job and exitcode is not None:
+    job['exitcode'] = exitcode
+  notify()
+
+def end_job(context, exitcode=None):
+  """Mark the job as finished."""
+  job = get_job(context)
+  if not job or job['ended'] is not None:
+    return
+  end_step(context, exitcode)
+  job['ended'] = time.time()
+  if job['hidden']:
+    with _lock:
+      _jobs.pop(job['id'], None)
+  for callback in job['on_end']:
+    callback()
+  notify()
+
+def on_end(context, callback):
+  """Call callback once the context's job ends, however its chain stops."""
+  job = get_job(context)
+  if job:
+    job['on_end'].append(callback)
+
+def kill_job(job_id):
+  """Kill every process of a job and stop the rest of its chain."""
+  job = _jobs.get(job_id)
+  if not job:
+    return False
+  job['killed'] = True
+  for step in job['steps']:
+    for proc in step['procs']:
+      if proc.poll():
+        proc.kill()
+  end_job({"job_id": job_id})
+  return True
+
+def mark_handled(context):
+  """Called by commando commands so next_commando knows the step was taken over."""
+  step = _current_step(context)
+  if step:
+    step['handled'] = True
+
+def waiting_on_procs(context):
+  """True if the current step handed the chain off to processes."""
+  step = _current_step(context)
+  return bool(step and step['procs'])
+
+def get_job(context):
+  if context:
+    return _jobs.get(context.get('job_id'))
+  return None
+
+def is_killed(context):
+  job = get_job(context)
+  return bool(job and job['killed'])
+
+def is_running(job):
+  return job['ended'] is None
+
+def running_jobs():
+  return [job for job in list(_jobs.values()) if is_running(job) and not job['hidden']]
+
+def _current_step(context):
+  job = get_job(context)
+  if job and job['steps']:
+    return job['steps'][-1]
+  return None
+
+def _command_name(command):
+  if isinstance(command, list):
+    return command[0]
+  return command
+
+def _prune():
+  """Forget the oldest finished jobs once there are more than MAX_RECENT."""
+  finished = [job_id for job_id, job in _jobs.items() if not is_running(job)]
+  for job_id in finished[:max(0, len(finished) - MAX_RECENT)]:
+    del _jobs[job_id]
+
+#
+# Panel
+#
+
+def format_duration(seconds):
+  if seconds < 60:
+    return "%.1fs" % seconds
+  return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+def format_bytes(count):
+  for unit in ['B', 'KB', 'MB']:
+    if count < 1024:
+      return ("%d" if unit == 'B' else "%.1f") % count + unit
+    count /= 1024.0
+  return "%.1fGB" % count
+
+def job_status(job):
+  if job['killed']:
+    return "killed"
+  if is_running(job):
+    if any(proc.poll() for step in job['steps'] for proc in step['procs']):
+      return "running"
+    return "waiting"
+  if job['exitcode']:
+    return "failed (" + str(job['exitcode']) + ")"
+  return "done"
+
+def format_jobs():
+  """Render the job list as plain text for the panel."""
+  now = time.time()
+  with _lock:
+    job_list = [job for job in _jobs.values() if not job['hidden']]
+  if not job_list:
+    return "No commando jobs.\n"
+
+  lines = []
+  for job in reversed(job_list):
+    elapsed = (job['ended'] or now) - job['started']
+    lines.append("#%d  %-12s %8s  %s" % (job['id'], job_status(job), format_duration(elapsed), job['name']))
+    for i, step in enumerate(job['steps']):
+      marker = '>' if is_running(job) and i == len(job['steps']) - 1 else ' '
+      line = "  %s %d. %-24s %8s" % (marker, i + 1, step['command'],
+        format_duration((step['ended'] or now) - step['started']))
+      if step['detail']:
+        line += "  " + step['detail']
+      lines.append(line)
+      for proc in step['procs']:
+        line = "         pid %-8s %10s" % (proc.pid, format_bytes(proc.bytes_out))
+        if not proc.poll():
+          line += "  exit " + str(proc.exit_code())
+        lines.append(line)
+    lines.append("")
+  return "\n".join(lines)
+
+def get_panel(window):
+  """The jobs panel of the window, only created if it doesn't exist yet."""
+  p = None
+  if hasattr(window, 'find_output_panel'):
+    p = window.find_output_panel(PANEL_NAME)
+  if p is None:
+    p = window.create_output_panel(PANEL_NAME)
+  return p
+
+def show_panel(window):
+  get_panel(window)
+  window.run_command("show_panel", {"panel": "output." + PANEL_NAME})
+  refresh_panels()
+
+def notify():
+  """Schedule a panel refresh, at most once every REFRESH_DELAY ms.
+
+  Safe to call from any thread.
+  """
+  global _refresh_pending
+  with _lock:
+    if _refresh_pending:
+      return
+    _refresh_pending = True
+  sublime.set_timeout(refresh_panels, REFRESH_DELAY)
+
+def refresh_panels():
+  global _refresh_pending
+  with _lock:
+    _refresh_pending = False
+
+  visible = [w for w in sublime.windows() if w.active_panel() == "output." + PANEL_NAME]
+  if not visible:
+    return
+
+  content = format_jobs()
+  for window in visible:
+    get_panel(window).run_command("simple_replace", {"contents": content})
+
+  # keep the elapsed times ticking while the panel is open and jobs are running
+  if running_jobs():
+    with _lock:
+      if _refresh_pending:
+        return
+      _refresh_pending = True
+    sublime.set_timeout(refresh_panels, TICK_DELAY)
@@ -3,7 +3,7 @@
 """
 import sublime, sublime_plugin
 import os
-from . import core
+from . import core, jobs
 
 class CommandoRun(sublime_plugin.ApplicationCommand):
   def run(self, commands=None, context=None):
@@ -39,6 +39,8 @@ class CommandoCmd(sublime_plugin.ApplicationCommand):
     if context is None:
       return
 
+    jobs.mark_handled(context)
+
     # process the arg vars
     self._do_var_subs(context, context['args'])
 
@@ -59,6 +61,9 @@ class CommandoCmd(sublime_plugin.ApplicationCommand):
     # continue the chain
     if ret != False:
       core.next_commando(context)
+    elif not jobs.waiting_on_procs(context):
+      # the chain stopped here; panel callbacks that pick it back up start a new job
+      jobs.end_job(context)
 
   def cmd(self, context):
     """Override on child."""
@@ -0,0 +1,154 @@
+"""Commando - Quick panel previews.
+
+on_highlighted chains run through a small LRU cache keyed by chain and item.
+Everything but the last command is treated as the (cacheable) work and the
+last command as the display step, so a cached item only re-runs the display.
+The items next to the highlighted one are fetched in the background.
+"""
+import sublime
+import collections
+import copy
+import json
+import time
+from . import core, jobs
+
+CACHE_SIZE = 50   # previews kept, least recently used are dropped first
+CONCURRENCY = 2   # prefetch chains allowed to run at the same time
+TIMEOUT = 30      # seconds before a preview chain that never finished is given up on
+
+_cache = collections.OrderedDict()
+_inflight = {}
+_queue = []
+_current = None
+_generation = 0 # bumped for every new quick panel, older results are ignored
+
+def highlighter(context, items, commands, prefetch=1):
+  """An on_highlighted callback for core.quick_panel, starting from an empty cache."""
+  reset()
+  def on_highlighted(i):
+    if i != -1:
+      preview(context, items, i, commands, prefetch)
+  return on_highlighted
+
+def reset():
+  """Forget cached previews, e.g. when a new quick panel opens."""
+  global _current, _queue, _generation
+  _generation += 1
+  _cache.clear()
+  _inflight.clear()
+  _queue = []
+  _current = None
+
+def preview(context, items, i, commands, prefetch=1):
+  """Run an on_highlighted chain for items[i], through the preview cache."""
+  global _current, _queue
+
+  if len(commands) < 2:
+    core.run_commando(None, context=_context(context, items[i], commands))
+    return
+
+  chain_key = json.dumps(commands, sort_keys=True)
+  _current = (chain_key, json.dumps(items[i], sort_keys=True))
+
+  # whatever was queued was for the previous neighbours
+  _queue = []
+  _fetch(context, items[i], commands, chain_key, show=True)
+  for offset in range(1, prefetch + 1):
+    for j in (i + offset, i - offset):
+      if 0 <= j < len(items):
+        _fetch(context, items[j], commands, chain_key)
+  _start_queued()
+
+def store(key, output, failed=False, generation=None):
+  """Called at the end of a preview chain with the input for the display step.
+
+  A failed chain frees its slot without being cached; its error is only
+  reported if its item is the one currently highlighted.  Results fetched
+  for an earlier quick panel are dropped.
+  """
+  if generation != _generation:
+    return
+
+  key = tuple(key)
+  fetch = _inflight.pop(key, None)
+
+  if failed:
+    if fetch and key == _current:
+      sublime.error_message(output)
+  else:
+    _cache[key] = output
+    _cache.move_to_end(key)
+    while len(_cache) > CACHE_SIZE:
+      _cache.popitem(last=False)
+    if fetch and key == _current:
+      _show(fetch['context'], fetch['commands'], output)
+
+  _start_queued()
+
+def _context(context, item, commands):
+  """A copy of the quick panel context for a preview run.
+
+  Previews run as hidden jobs (see jobs.start_job), scrolling would
+  otherwise push the real jobs out of the commando_jobs list within a few
+  keypresses.
+  """
+  preview_context = dict(context)
+  preview_context['job_id'] = None
+  preview_context['untracked'] = True
+  preview_context['args'] = {}
+  preview_context['input'] = item
+  preview_context['commands'] = copy.deepcopy(commands)
+  return preview_context
+
+def _show(context, commands, output):
+  core.run_commando(None, context=_context(context, output, commands[-1:]))
+
+def _fetch(context, item, commands, chain_key, show=False):
+  key = (chain_key, json.dumps(item, sort_keys=True))
+
+  if key in _cache:
+    _cache.move_to_end(key)
+    if show:
+      _show(context, commands, _cache[key])
+    return
+
+  fetch = _inflight.get(key)
+  if fetch and time.time() - fetch['started'] < TIMEOUT:
+    return # already running, store shows it if it's still highlighted
+
+  fetch_context = _context(context, item, commands[:-1])
+  store_args = {"preview_key": list(key), "generation": _generation}
+  fetch_context['commands'].append(["commando_preview_store", store_args])
+  fetch_context['on_error'] = [["commando_preview_store", dict(store_args, failed=True)]]
+  fetch = {"context": context, "commands": commands, "fetch_context": fetch_context}
+
+  if show:
+    _run(key, fetch)
+  else:
+    _queue.append((key, fetch))
+
+def _run(key, fetch):
+  fetch['started'] = time.time()
+  _inflight[key] = fetch
+  # a chain can stop before reaching commando_preview_store (a command
+  # returning False), its slot is freed when its job ends either way
+  jobs.start_job(fetch['fetch_context'])
+  jobs.on_end(fetch['fetch_context'], lambda: _ended(key, fetch))
+  core.run_commando(None, context=fetch['fetch_context'])
+
+def _ended(key, fetch):
+  if _inflight.get(key) is fetch:
+    del _inflight[key]
+  _start_queued()
+
+def _start_queued():
+  """Start queued prefetches while fewer than CONCURRENCY are running."""
+  now = time.time()
+  for key, fetch in list(_inflight.items()):
+    if now - fetch['started'] >= TIMEOUT:
+      del _inflight[key]
+
+  while _queue and len(_inflight) < CONCURRENCY:
+    key, fetch = _queue.pop(0)
+    if key not in _cache and key not in _inflight:
+      _run(key, fetch)
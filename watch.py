@@ -0,0 +1,206 @@
+"""Commando - Watch mode.
+
+A watch attaches a chain to file saves in a window.  The chain is re-run for
+a saved file only when the file's content hash changed since its last run,
+and each file's output is kept as its own section of the watch panel.
+"""
+import sublime
+import copy
+import fnmatch
+import hashlib
+import os
+from . import core
+
+_watches = {}
+
+def key(window_id, name):
+  return str(window_id) + ":" + name
+
+def panel_name(name):
+  return "commando_watch_" + name
+
+def add_watch(context, name, commands, working_dir, pattern="*"):
+  """Register (or replace) a watch for the context's window."""
+  watch = {
+    "name": name,
+    "window_id": context['window_id'],
+    "view_id": context['view_id'],
+    "working_dir": working_dir,
+    "pattern": pattern,
+    "commands": commands,
+    "files": {},
+    "sections": []
+  }
+  _watches[key(context['window_id'], name)] = watch
+  reset_panel(watch)
+  return watch
+
+def remove_watch(window_id, name=None):
+  """Remove one watch, or every watch of the window if no name is given."""
+  removed = []
+  for k, watch in list(_watches.items()):
+    if watch['window_id'] == window_id and (name is None or watch['name'] == name):
+      removed.append(_watches.pop(k))
+  for watch in removed:
+    reset_panel(watch)
+  return removed
+
+def get_watch(window_id, name):
+  return _watches.get(key(window_id, name))
+
+def watches_for(window_id, filename):
+  """The watches of a window that apply to the given file."""
+  matched = []
+  for watch in list(_watches.values()):
+    if watch['window_id'] != window_id:
+      continue
+    if watch['working_dir'] and not filename.startswith(watch['working_dir'] + os.sep):
+      continue
+    if not fnmatch.fnmatch(os.path.basename(filename), watch['pattern']):
+      continue
+    matched.append(watch)
+  return matched
+
+def normalize(watch, filename):
+  if watch['working_dir'] and not os.path.isabs(filename):
+    filename = os.path.join(watch['working_dir'], filename)
+  return os.path.abspath(filename)
+
+def file_hash(filename):
+  """Content hash of a file, read in blocks."""
+  digest = hashlib.sha1()
+  try:
+    with open(filename, 'rb') as f:
+      for block in iter(lambda: f.read(2**16), b''):
+        digest.update(block)
+  except (IOError, OSError):
+    return None
+  return digest.hexdigest()
+
+def changed(watch, filename):
+  """Return (run number, content hash) if the file changed since its last
+  successful run, otherwise None.
+
+  The hash is only stored by set_result, so a chain that stops early is
+  retried on the next save even if the content is the same.
+  """
+  content_hash = file_hash(filename)
+  state = watch['files'].setdefault(filename, {"hash": None, "run": 0, "output": ""})
+  if content_hash is None or content_hash == state['hash']:
+    return None
+  state['run'] += 1
+  return state['run'], content_hash
+
+def build_context(watch, filename, run, content_hash, view_id=None):
+  """A fresh context that runs the watch chain for one file.
+
+  A failing commando_exec (a linter finding problems) hands its output to
+  the on_error step instead of opening an error dialog.
+  """
+  result_args = {
+    "watch": watch['name'],
+    "file": filename,
+    "run": run,
+    "hash": content_hash
+  }
+  commands = copy.deepcopy(watch['commands'])
+  commands.append(["commando_watch_result", result_args])
+  return {
+    "window_id": watch['window_id'],
+    "view_id": view_id or watch['view_id'],
+    "args": {},
+    "input": filename,
+    "commands": commands,
+    "on_error": [["commando_watch_result", dict(result_args, failed=True)]]
+  }
+
+def run_file(watch, filename, view_id=None):
+  """Run the watch chain for a file, unless its content is unchanged.
+
+  Hashes the file on the calling thread, so call it off the UI thread; the
+  chain itself is started back on the main thread.
+  """
+  change = changed(watch, filename)
+  if change is None:
+    return False
+  run, content_hash = change
+  context = build_context(watch, filename, run, content_hash, view_id)
+  sublime.set_timeout(lambda: core.run_commando(None, context=context), 0)
+  return True
+
+def run_files(watch, filenames):
+  for filename in filenames:
+    run_file(watch, filename)
+
+def set_result(watch, filename, run, content_hash, output, failed=False):
+  """Store the chain output for a file. Outdated runs are dropped.
+
+  The content hash is only kept for successful runs, so a failed file is
+  run again on the next save.
+  """
+  state = watch['files'].get(filename)
+  if not state or state['run'] != run:
+    return False
+  state['hash'] = None if failed else content_hash
+  state['output'] = output or ""
+  return True
+
+def section(watch, filename):
+  """The panel text for one file; empty when its chain produced no output."""
+  output = watch['files'][filename]['output'].replace("\r\n", "\n")
+  if output.strip() == '':
+    return ""
+  if watch['working_dir']:
+    filename = os.path.relpath(filename, watch['working_dir'])
+  return "== " + filename + " ==\n" + output.rstrip() + "\n\n"
+
+def reset_panel(watch):
+  """Empty the watch panel, its sections start over from offset 0."""
+  window = core.get_window_by_id(watch['window_id'])
+  if window:
+    p = window.create_output_panel(panel_name(watch['name']))
+    p.run_command("simple_replace", {"contents": ""})
+
+def update_panel(watch, filename, show=False):
+  """Replace just this file's section of the watch panel.
+
+  Sections are laid out in the order files first produced a result, so a
+  file's offset is the length of the sections before it.
+  """
+  window = core.get_window_by_id(watch['window_id'])
+  if not window:
+    return
+
+  sections = watch['sections']
+  new_text = section(watch, filename)
+
+  offset = 0
+  old_text = None
+  for entry in sections:
+    if entry[0] == filename:
+      old_text = entry[1]
+      entry[1] = new_text
+      break
+    offset += len(entry[1])
+  if old_text is None:
+    old_text = ""
+    sections.append([filename, new_text])
+
+  name = panel_name(watch['name'])
+  p = None
+  if hasattr(window, 'find_output_panel'):
+    p = window.find_output_panel(name)
+
+  if p is None:
+    # no panel yet (or no way to find it again), write every section
+    p = window.create_output_panel(name)
+    p.run_command("simple_replace", {"contents": "".join(entry[1] for entry in sections)})
+  elif new_text != old_text:
+    p.run_command("simple_replace", {
+      "contents": new_text,
+      "begin": offset,
+      "end": offset + len(old_text)
+    })
+
+  if show and new_text:
+    window.run_command("show_panel", {"panel": "output." + name})